@@ -8,19 +8,26 @@ Created on Sun May 19 21:14:25 2024
 
 # %% Imports
 
-import sqlite3
 import pandas as pd
+import numpy as np
 import re
+import re2
+import warnings
 import json
+import orjson
+import hyperscan as hs
 import argparse
-import langdetect  
-from langdetect import detect_langs as detect_languages
+import fasttext
+from collections import Counter
+from multiprocessing import Pool, cpu_count
 from pathlib import Path
 from datetime import datetime
 
 
 ACCEPTED_LANGUAGES=['en','fr','nl']
 
+MATCHES_COLUMNS=['index','id','field','pattern','sub_pattern','start','end','extract']
+
 # %% Import list of fields to score
 
 def import_scoring_fields(school):
@@ -30,7 +37,11 @@ def import_scoring_fields(school):
 
 # %% Languages detection
 
-def find_language(text, declared_languages):
+# fastText language identification model, to be downloaded from 
+# https://dl.fbaipublicfiles.com/fasttext/supervised-models/lid.176.ftz
+language_model=fasttext.load_model(str(Path(__file__).parent.absolute().joinpath("../../data/language-models/lid.176.ftz")))
+
+def find_languages(texts, declared_languages):
     
     '''
     The scorer can be used to find terms in course descriptions. Terms are 
@@ -50,51 +61,101 @@ def find_language(text, declared_languages):
     This function determines the language of the regular expressions to be used 
     to analyse the texts. This language must be a supporte language.
     
-    The function analyses the language of the description. If the detection 
-    fails (the langdetect package is very efficient but sometimes fails to
-    detect the language of a descritpion) then we'll take into 
-    account the language(s) of the lesson as declared by the teacher. 
+    The function analyses the language of the descriptions. All descriptions 
+    are analysed at once by the fastText model (much faster than analysing 
+    them one by one). If the detection fails (no supported language detected) 
+    then we'll take into account the language(s) of the lesson as declared by 
+    the teacher. 
     
     The function only return supported languages (unsupported languages
     are filtered out).
     
     Args:
-        text : the text to analyse
-        declared_languages : langugage(s) of the lesson as declared by the teacher.
+        texts : the texts to analyse
+        declared_languages : for each text, langugage(s) of the lesson as declared by the teacher.
         
     Returns:
-        List of languages.
+        For each text, list of languages.
 
     Examples:
         
-    >>> find_language("La descrizione è in italiano. Car il s'agit d'un cours d'italien mais qui se donne aussi en français",['it'])
-    ['fr']
+    >>> find_languages(["La descrizione è in italiano. Car il s'agit d'un cours d'italien mais qui se donne aussi en français"],[['it']])
+    [['fr']]
 
-    >>> find_language("La descrizione è in italiano.",['it'])
-    []
+    >>> find_languages(["La descrizione è in italiano."],[['it']])
+    [[]]
 
-    >>> find_language("The description of the course in in English",['en','fr'])
-    ['en']
+    >>> find_languages(["The description of the course in in English"],[['en','fr']])
+    [['en']]
 
-    >>> find_language("The description of the course in in English",['fr'])
-    ['en']
+    >>> find_languages(["The description of the course in in English",None],[['fr'],['fr']])
+    [['en'], None]
     '''
     
-    if text is None:
-        return None
+    # Identical texts (eg: courses sharing the same description) are only analysed once
+    unique_texts = list(dict.fromkeys(text for text in texts if text))
     
-    try:
-        detected_and_supported_languages = [l.lang for l in detect_languages(text) if l.lang in ACCEPTED_LANGUAGES ]
-    except langdetect.lang_detect_exception.LangDetectException:
-        return None
-
-    if not detected_and_supported_languages:
-        declared_and_supported_languages=set(declared_languages).intersection(set(ACCEPTED_LANGUAGES))
-        declared_and_supported_languages=list(declared_and_supported_languages)
-        return declared_and_supported_languages
-    else:
-        return detected_and_supported_languages
+    # fastText works line by line
+    detected_languages, _ = language_model.predict([text.replace('\n',' ') for text in unique_texts],
+                                                   k=3,threshold=0.1) if unique_texts else ([],[])
+    detected_languages = dict(zip(unique_texts,detected_languages))
+    
+    languages=[]
+    
+    for text, declared in zip(texts,declared_languages):
+        
+        if not text:
+            languages += [None]
+            continue
+        
+        detected_and_supported_languages = [l.replace('__label__','') for l in detected_languages[text] if l.replace('__label__','') in ACCEPTED_LANGUAGES]
+        
+        if not detected_and_supported_languages:
+            declared_and_supported_languages=set(declared).intersection(set(ACCEPTED_LANGUAGES))
+            declared_and_supported_languages=list(declared_and_supported_languages)
+            languages += [declared_and_supported_languages]
+        else:
+            languages += [detected_and_supported_languages]
+    
+    return languages
+
+
+# %% Text cleaning
 
+# Whitespace characters other than ASCII ones (RE2 only matches ASCII whitespace 
+# with \s, unlike re and Hyperscan in UCP mode)
+UNICODE_WHITESPACES = "\x0b\x1c\x1d\x1e\x1f\x85\u1680\u2000\u2001\u2002\u2003\u2004\u2005" \
+                      "\u2006\u2007\u2008\u2009\u200a\u2028\u2029\u202f\u205f\u3000"
+
+# Annoying characters and their replacements (the translation table is built once)
+TRANSLATION_MAP = [    
+                     ("\xa0", " "),
+                     ("’"   , "'"),
+                  ] + [(c," ") for c in UNICODE_WHITESPACES]
+
+TRANSLATION_MAP = str.maketrans(''.join([x for (x,y) in TRANSLATION_MAP ]),
+                                ''.join([y for (x,y) in TRANSLATION_MAP ]))
+
+def clean_texts(texts):
+    
+    '''
+    This function gets rid of some annoying characters that cause some 
+    troubles (texts is a pandas Series). The process has no effect on the 
+    length of texts. 
+    
+    Non-ASCII whitespace characters are replaced by spaces, so that they are 
+    considered as blank characters by RE2 and Hyperscan alike.
+    
+    Examples:
+        
+    >>> clean_texts(pd.Series(["changement\\u202fclimatique", "l\\u2019\\xa0effet"])).tolist()
+    ['changement climatique', "l' effet"]
+    
+    >>> re2.search(r'changement\\s+climatique', clean_texts(pd.Series(["changement\\x85climatique"]))[0]) is not None
+    True
+    '''
+    
+    return texts.str.translate(TRANSLATION_MAP)
 
 # %% Import courses informations
 
@@ -106,8 +167,14 @@ def import_courses(school,year,scoring_fields):
     Remarks:
         - We get rid of some annoying characters that cause some troubles. The 
           process has no effect on the length of texts. 
-        - We are also making use of the find_language function to detect 
-          languages of course description fields. We create new variables 
+        - Patterns are searched in lower case copies of the scoring fields 
+          (patterns are lower case too and matching is case sensitive, which 
+          is faster). Lower case copies have the same length as the original 
+          texts, so that positions of matches are valid in both.
+        - We are also making use of the find_languages function to detect 
+          the languages of the course descriptions. Languages are detected 
+          once per course, on the concatenation of the description fields 
+          (all scoring fields but the first one). We create a new variable 
           in the resulting DataFrame to store this information.
     
     '''
@@ -118,24 +185,19 @@ def import_courses(school,year,scoring_fields):
     
     
     # Get rid of some annonying characters
-    translation_map = [    
-                         ("\xa0", " "),
-                         ("’"   , "'"),
-                      ]
-        
-    translation_map=str.maketrans(''.join([x for (x,y) in translation_map ]),
-                                  ''.join([y for (x,y) in translation_map ]))
-    
-    def clean_text(text: str):
-        text=text.translate(translation_map)
-        return text
-    
     for scoring_field in scoring_fields:
-        courses[scoring_field] = courses[scoring_field].apply(clean_text)
+        courses[scoring_field] = clean_texts(courses[scoring_field])
 
-    # Detect languages of scoring fields
-    for scoring_field in scoring_fields[1:]: 
-        courses[f"{scoring_field}_languages4scoring"]=courses.apply(lambda course: find_language(getattr(course,scoring_field,None),course.languages),axis=1)
+    # Lower case copies of scoring fields (characters whose lower case is longer, eg: 'İ', are left unchanged)
+    for scoring_field in scoring_fields:
+        lowercase = courses[scoring_field].str.lower()
+        changed   = courses[scoring_field].notna() & (lowercase.str.len() != courses[scoring_field].str.len())
+        lowercase[changed] = courses.loc[changed,scoring_field].apply(lambda text: ''.join(c if len(c.lower())>1 else c.lower() for c in text))
+        courses[f"{scoring_field}4scoring"] = lowercase
+
+    # Detect languages of scoring fields (descriptions of a course are written in the same language)
+    descriptions=courses[scoring_fields[1:]].fillna('').agg(' '.join,axis=1).str.strip()
+    courses["languages4scoring"]=find_languages(descriptions.tolist(),courses['languages'].tolist())
         
     return courses
 
@@ -148,9 +210,11 @@ def import_patterns():
     patterns=pd.read_json(f'{root}/data/patterns/patterns.json')
     
     # We'll consider tab characters, return characters, ... like blank characters
+    # Patterns are matched against lower case texts (patterns.json contains no escapes, like \S, that lowering would alter)
     def correct(pattern):
         if pattern is not None:
-            return pattern.replace('[- ]','[\-\s]')\
+            return pattern.lower()\
+                          .replace('[- ]','[\-\s]')\
                           .replace('[^ ]','[^\s]' )\
                           .replace(' '   ,'\s+'   )
     
@@ -158,9 +222,10 @@ def import_patterns():
         patterns[p] = patterns[p].apply(correct)
     
     # Split and compile patterns (will simplify subsequent code and make it more performant)
+    # RE2 guarantees linear-time matching (no backtracking)
     def break_into_sub_patterns(pattern):
         if pattern is not None:
-            return [re.compile(pat, re.IGNORECASE) for pat in pattern.split("#") ]
+            return [re2.compile(pat) for pat in pattern.split("#") ]
         else:
             return []
     
@@ -173,58 +238,225 @@ def import_patterns():
                              'pattern_fr':'fr',
                              'pattern_nl':'nl'},inplace=True)
 
+    # Compile all sub-patterns of a language into one Hyperscan database 
+    # (a single scan of a text will then tell us which sub-patterns it contains)
+    pattern_records=patterns.to_dict('records')
+    databases={language:compile_database(pattern_records,language) for language in ACCEPTED_LANGUAGES}
 
-    return patterns
+    return patterns, databases
 
-# %% Function to find patterns in courses
+def minimal_length(sub_pattern):
+    
+    '''
+    This function returns a lower bound of the length of the texts matched by 
+    a sub-pattern. 
+    
+    The length is measured by the parser of re, whose syntax is close to, but 
+    not the same as, the syntax of RE2. Whenever the parser fails or warns 
+    about the sub-pattern (eg: RE2-only syntax, nested sets), the bound is 0, 
+    so that no text that could match is ever discarded.
+    
+    Examples:
+        
+    >>> minimal_length('approches?\\s+bioclimat')
+    18
+    
+    >>> minimal_length('(?:de\\s+)?serre')
+    5
+    
+    >>> minimal_length('\\pL+')
+    0
+    
+    >>> minimal_length('[[:alpha:]]+')
+    0
+    '''
+    
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            return re._parser.parse(sub_pattern).getwidth()[0]
+    except Exception:
+        return 0
 
-def find_pattern_in_course_field(course,scoring_field,pattern,db):
+def compile_database(pattern_records,language):
+    
+    '''
+    This function compiles the sub-patterns of a language into a Hyperscan 
+    database. Hyperscan is only used to detect, in one pass over a text, which 
+    sub-patterns are present in it. Matches themselves (and their positions) 
+    are still extracted using the compiled regular expressions, so results are 
+    not affected.
+    
+    Returns:
+        The Hyperscan database and the list of (pattern id, sub-pattern index) 
+        tuples corresponding to the expression ids of the database.
+    '''
+    
+    expressions = []
+    ids         = []
+    
+    for pattern in pattern_records:
+        for sub_pattern_index, sub_pattern in enumerate(pattern[language]):
+            expressions += [sub_pattern.pattern.encode('utf-8')]
+            ids         += [(pattern['id'],sub_pattern_index)]
+    
+    # Sub-patterns that can match an empty string (eg: after a stray '#') are accepted, as by RE2
+    database = hs.Database(mode=hs.HS_MODE_BLOCK)
+    database.compile(expressions=expressions,
+                     ids=list(range(len(expressions))),
+                     elements=len(expressions),
+                     flags=[hs.HS_FLAG_UTF8|hs.HS_FLAG_UCP|hs.HS_FLAG_SINGLEMATCH|hs.HS_FLAG_ALLOWEMPTY]*len(expressions))
     
-    text = getattr(course,scoring_field,None)
-    if not text: # If text is missing then silently return
-        return
+    return database, ids
 
-    languages = getattr(course,f"{scoring_field}_languages4scoring",None) 
-    if not languages: # If text language is not supported then silently return
-        return   
+# %% Function to find candidate patterns in a course field
 
-    main_language=languages[0]
+def find_candidate_patterns(text,database,ids,sub_patterns_by_pattern):
+    
+    '''
+    This function scans a text once using the Hyperscan database of its 
+    language and returns the ids of the patterns for which all sub-patterns 
+    are present in the text (only those patterns can match), in the order of 
+    patterns.json.
+    '''
+    
+    matched_sub_patterns=set()
+    
+    def on_match(expression_id, start, end, flags, context):
+        matched_sub_patterns.add(ids[expression_id])
+    
+    database.scan(text.encode('utf-8'),match_event_handler=on_match)
     
-    sub_patterns = getattr(pattern, main_language,None)
-    if not sub_patterns:
-        return # If there is no sub_pattern, then silently return
+    matched_patterns=Counter(pattern_id for (pattern_id,_) in matched_sub_patterns)
+    
+    return sorted(pattern_id for pattern_id, count in matched_patterns.items() 
+                             if count==len(sub_patterns_by_pattern[pattern_id]))
 
-    matched_patterns      = []
+# %% Function to find patterns in courses
 
-    for sub_pattern in sub_patterns:
+def find_pattern_in_course_field(course_id,scoring_field,text,pattern_id,sub_patterns,matches):
 
-        sub_pattern_matches = list(sub_pattern.finditer(text))
+    # Matches are appended directly, and removed if a sub-pattern turns out not to match
+    # (candidates come from Hyperscan, so this hardly ever happens)
+    mark  = len(matches)
+    index = 0
 
-        if not sub_pattern_matches:
-            return # If there are no matches for a sub-pattern, stop the search
+    for sub_pattern in sub_patterns:
+
+        count_of_matches = len(matches)
 
-        for sub_pattern_match in sub_pattern_matches:
+        for sub_pattern_match in sub_pattern.finditer(text):
             start, end = sub_pattern_match.span()
-            matched_patterns +=  [
-                                      {
-                                       'id'          :course.id                                         ,
-                                       'field'       :scoring_field                                     ,
-                                       'pattern'     :pattern.id                                        ,
-                                       'sub_pattern' :sub_pattern.pattern                               ,
-                                       'start'       :start                                             ,
-                                       'end'         :end                                               ,
-                                       'extract'     :text[max(0, start-20) : min(end+20, len(text)-1)] ,
-                                      }
-                                  ]
-
-    matched_patterns=pd.DataFrame.from_dict(matched_patterns)
-    matched_patterns.to_sql('T_matches',db,if_exists='append')
+            matches.append(
+                            (
+                             index                                             ,
+                             course_id                                         ,
+                             scoring_field                                     ,
+                             pattern_id                                        ,
+                             sub_pattern.pattern                               ,
+                             start                                             ,
+                             end                                               ,
+                            )
+                          )
+            index += 1
+
+        if len(matches) == count_of_matches:
+            del matches[mark:]
+            return # If there are no matches for a sub-pattern, stop the search
 
     return
 
+def extract(text,start,end):
+    
+    '''
+    This function returns the extract of a text around a match (20 characters
+    on each side).
+    '''
+    
+    return text[max(0, start-20) : min(end+20, len(text)-1)]
+
+# %% Parallel scoring of courses
+
+# State of a worker process, set once by init_worker
+worker_context={}
+
+def init_worker(scoring_fields,serialized_databases,sub_pattern_sources):
+    
+    '''
+    This function initialises a worker process. Hyperscan databases are 
+    compiled once by the main process and deserialized here, sub-patterns are 
+    compiled again from their sources (compiled objects can't be pickled).
+    '''
+    
+    def load_database(serialized_database):
+        database = hs.loadb(serialized_database,mode=hs.HS_MODE_BLOCK)
+        database.scratch = hs.Scratch(database) # Deserialized databases have no scratch space
+        return database
+    
+    worker_context['scoring_fields'] = scoring_fields[1:] # The first scoring field is not scored
+    worker_context['databases']      = {language:(load_database(database),ids) 
+                                        for language,(database,ids) in serialized_databases.items()}
+    worker_context['patterns']       = {language:{pattern_id:[re2.compile(source) for source in sources] 
+                                                  for pattern_id,sources in patterns.items()}
+                                        for language,patterns in sub_pattern_sources.items()}
+
+def process_course(course):
+    
+    '''
+    This function finds all patterns in the scoring fields of a course (a dict)
+    and returns the list of matches (without extracts, see score).
+    
+    Courses are the outermost loop (not fields): a course is the unit of work 
+    of process_courses, and matches keep the order course -> pattern -> field 
+    of the original scorer. Lookups (language, database, sub-patterns, texts) 
+    are done once per course and field.
+    '''
+    
+    matches=[]
+    
+    languages = course['languages4scoring']
+    if not languages: # If language is not supported, skip the course
+        return matches
+    
+    main_language=languages[0]
+    database, ids = worker_context['databases'][main_language]
+    sub_patterns_by_pattern = worker_context['patterns'][main_language]
+    
+    # Only patterns having all their sub-patterns in a text are searched in it
+    candidate_patterns = {}
+    for field in worker_context['scoring_fields']:
+        text = course[f"{field}4scoring"]
+        if text: # If text is missing, skip it
+            for pattern_id in find_candidate_patterns(text,database,ids,sub_patterns_by_pattern):
+                candidate_patterns.setdefault(pattern_id,[]).append(field)
+    
+    # Matches are listed by pattern (in the order of patterns.json), then by field
+    for pattern_id in sorted(candidate_patterns):
+        for field in candidate_patterns[pattern_id]:
+            find_pattern_in_course_field(course['id'],field,course[f"{field}4scoring"],pattern_id,sub_patterns_by_pattern[pattern_id],matches)
+    
+    return matches
+
+def process_courses(records,jobs,initargs):
+    
+    '''
+    This function yields the matches of each course of records, in order. 
+    Courses are processed in the current process when jobs is 1 (the default: 
+    for catalogues of a few thousand courses, starting and initialising worker 
+    processes costs more than the matching itself), otherwise by a pool of 
+    jobs worker processes (0 means one per CPU).
+    '''
+    
+    if jobs == 1:
+        init_worker(*initargs)
+        yield from map(process_course,records)
+    else:
+        with Pool(jobs or cpu_count(),initializer=init_worker,initargs=initargs) as pool:
+            yield from pool.imap(process_course,records,chunksize=16)
+
 # %% Score
 
-def score(school,year):
+def score(school,year,jobs=1):
     
     print(f'{datetime.now().isoformat()} - Import scoring field')
     scoring_fields = import_scoring_fields(school)
@@ -233,29 +465,54 @@ def score(school,year):
     courses        = import_courses(school,year,scoring_fields)
     
     print(f'{datetime.now().isoformat()} - Import patterns')
-    patterns       = import_patterns()
-    
-    db=sqlite3.connect(':memory:')
-    
-    ms_countOf_courses,_=courses.shape
-    ms_countOf_patterns,_=patterns.shape
-    ms_countOf_scoringFields=len(scoring_fields)
-    ms_countOf_matchFunctionCalls=ms_countOf_courses*ms_countOf_patterns*ms_countOf_scoringFields
-    
-    c,s=0,0
-    
-    for course in courses.itertuples():
-        c+=1
-        for pattern in patterns.itertuples():
-            for field in scoring_fields:
-                s+=1
-                find_pattern_in_course_field(course,field,pattern,db)
-                if s%100000==0:
-                    print(f'{datetime.now().isoformat()} - step {s} - course {c}/{ms_countOf_courses} - progress {s/ms_countOf_matchFunctionCalls:.2%}')
+    patterns, databases = import_patterns()
+    
+    matches=[]
+    
+    # Sources of the sub-patterns of each language, by pattern id (patterns without sub-patterns are left out)
+    pattern_records      = patterns.to_dict('records')
+    sub_pattern_sources  = {language:{pattern['id']:[sub_pattern.pattern for sub_pattern in pattern[language]] 
+                                      for pattern in pattern_records if pattern[language]} 
+                            for language in ACCEPTED_LANGUAGES}
+    serialized_databases = {language:(hs.dumpb(database),ids) for language,(database,ids) in databases.items()}
+    
+    # Texts shorter than the minimal length of the patterns of their language can't match,
+    # they are removed before scoring (courses with no text left are not scored at all).
+    # A pattern needs all its sub-patterns to match.
+    minimal_lengths = {language:min(max(minimal_length(sub_pattern.pattern) for sub_pattern in sub_patterns) 
+                                    for sub_patterns in patterns[language] if sub_patterns)
+                       for language in ACCEPTED_LANGUAGES}
+    thresholds      = np.array([minimal_lengths[languages[0]] if languages else np.iinfo(np.uint32).max 
+                                for languages in courses['languages4scoring']],dtype=np.uint32)
+    
+    columns = ['id']+scoring_fields+[f"{field}4scoring" for field in scoring_fields]+['languages4scoring']
+    courses = courses[columns].copy()
+    scored  = np.zeros(len(courses),dtype=bool)
+    
+    for field in scoring_fields[1:]:
+        lengths = courses[field].str.len().fillna(0).to_numpy(dtype=np.uint32)
+        mask    = lengths >= thresholds
+        courses.loc[~mask,f"{field}4scoring"] = None
+        scored |= mask
+    
+    records = courses[scored].to_dict('records')
+    ms_countOf_courses=len(records)
+    
+    # Matches are stored with the position of their course in records (course ids are not always unique)
+    initargs=(scoring_fields,serialized_databases,sub_pattern_sources)
+    for row, course_matches in enumerate(process_courses(records,jobs,initargs)):
+        matches.extend((row,)+course_match for course_match in course_matches)
+        if (row+1)%100==0:
+            print(f'{datetime.now().isoformat()} - course {row+1}/{ms_countOf_courses} - progress {(row+1)/ms_countOf_courses:.2%}')
     
     # %% Export of results
     
-    pd.read_sql('select * from T_matches',db).to_json(f'{root}/data/scorer-output/{school}_{year}.json',indent=5,index=False,orient='records')
+    # Extracts are only computed now, in one pass over the matches
+    matches=[dict(zip(MATCHES_COLUMNS,(index,course_id,field,pattern_id,sub_pattern,start,end,extract(records[row][field],start,end))))
+             for row,index,course_id,field,pattern_id,sub_pattern,start,end in matches]
+    
+    with open(f'{root}/data/scorer-output/{school}_{year}.json','wb') as f:
+        f.write(orjson.dumps(matches,option=orjson.OPT_INDENT_2))
 
 # %% Score
 
@@ -264,11 +521,13 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-s", "--school", help="School code", default='uclouvain')
     parser.add_argument("-y", "--year", help="Academic year", default=2023)
+    parser.add_argument("-j", "--jobs", help="Number of worker processes (0: one per CPU)", type=int, default=1)
 
     arguments = vars(parser.parse_args())
     
     school=arguments['school']
     year=arguments['year']
+    jobs=arguments['jobs']
     
     root=Path(__file__).parent.absolute().joinpath("../..")
     
@@ -277,7 +536,7 @@ if __name__ == "__main__":
     print(f'Root directory: {root}')
     
     print('Process starts ...')
-    score(school,year)
+    score(school,year,jobs)
     print('Process ends')
     
 